@@ -1,16 +1,17 @@
-from flask import Flask, render_template
-from text_detector import get_image_uris
+from quart import Quart, render_template, request
+from text_detector import get_images
 import secrets
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 # Set a secret key for session management
 app.secret_key = secrets.token_hex(16)  # Generates a secure random string
 
 @app.route('/', methods=['GET'])
-def get_image():
-    image_uris = get_image_uris()
-    return render_template('display_images.html', image_uris=image_uris)
+async def get_image():
+    # "?refresh" bypasses the cached listings and re-lists the bucket
+    images = await get_images(refresh='refresh' in request.args)
+    return await render_template('display_images.html', images=images)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -1,13 +1,90 @@
+import asyncio
 import io
+import json
 import os
 import logging
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import math
+from cachetools import Cache, TTLCache, cached
+import redis.asyncio as redis
+import google.auth.credentials
+import google.auth.transport.requests
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import vision, storage
-from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcAsyncIOTransport
+from PIL import Image
 import numpy as np
+import cv2
 
 # Get the bucket name from the environment variable set in app.yaml
 BUCKET_NAME = 'comp-399-vision'
 
+# Original images are read from RAW_PREFIX and the bounding boxes detected on them are stored as JSON under
+# BOXED_PREFIX, e.g. "raw/receipts/001.png" -> "boxed/receipts/001.json"
+RAW_PREFIX = 'raw/'
+BOXED_PREFIX = 'boxed/'
+
+# Extensions of the image files that are processed
+IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp'})
+
+# Maximum number of images the Vision API accepts in a single batch_annotate_images request
+VISION_BATCH_SIZE = 16
+
+# Number of images sent in each async_batch_annotate_images request. The API accepts up to 2000, but smaller
+# chunks run side by side and each finishes well within OCR_OPERATION_TIMEOUT.
+VISION_ASYNC_BATCH_SIZE = 200
+
+# Seconds to wait for an asynchronous batch request to finish, and for one the page load gave up on to end
+# before its results are deleted
+OCR_OPERATION_TIMEOUT = 600
+OCR_ABANDONED_OPERATION_TIMEOUT = 3600
+
+# Prefix under which the Vision API writes the JSON results of asynchronous batch requests,
+# and the number of image responses it writes to each JSON file
+OCR_OUTPUT_PREFIX = 'ocr/'
+OCR_OUTPUT_BATCH_SIZE = 20
+
+# Lifetime of the signed URLs the browser loads the original images from (V4 signatures allow at most 7 days)
+SIGNED_URL_EXPIRATION = timedelta(days=7)
+
+# Seconds a signed URL is reused, so browsers can cache the images across page loads. Kept well below
+# SIGNED_URL_EXPIRATION so a reused URL stays valid for days after it's served.
+SIGNED_URL_CACHE_TTL = timedelta(days=1).total_seconds()
+
+# Process-wide caps on concurrent GCS transfers and Vision requests, shared by all page loads, to stay under
+# the API quotas. Each stage has its own cap so a slow Vision call doesn't hold back uploads and downloads.
+MAX_CONCURRENT_REQUESTS = 8
+MAX_CONCURRENT_VISION_REQUESTS = 8
+
+# Options of the shared Vision gRPC channel: no message size limits (the client library default, large photos
+# fit in a request) and keepalive pings so the channel stays open between page loads
+VISION_CHANNEL_OPTIONS = [
+    ('grpc.max_send_message_length', -1),
+    ('grpc.max_receive_message_length', -1),
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+]
+
+# Custom metadata key set on an original image once processed, holding its annotation's blob name,
+# or ANNOTATION_NO_TEXT when no text was found even after preprocessing
+ANNOTATION_METADATA_KEY = 'annotation'
+ANNOTATION_NO_TEXT = 'no-text'
+
+# Number of seconds a bucket listing is reused before the bucket is listed again
+LISTING_CACHE_TTL = 60
+
+# Redis instance holding the stored annotations, keyed by blob name; when unset the bucket is read instead
+REDIS_URL = os.environ.get('REDIS_URL')
+ANNOTATIONS_KEY = 'annotations'
+
+# Seconds to wait for Redis to connect or answer before falling back to the bucket
+REDIS_TIMEOUT = 0.5
+
 ### ONLY FOR LOCAL TESTING
 # Set the path to your Google Cloud service account credentials
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = r'C:\Programming\Dev\secrets\vision-text-detector-2024-0632f72c7099.json'
@@ -15,46 +92,224 @@ os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = r'C:\Programming\Dev\secrets\visi
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# Worker threads for the blocking Cloud Storage client calls, and for decoding and preprocessing images
+# off the event loop (Pillow and NumPy release the GIL while they work)
+io_executor = ThreadPoolExecutor(max_workers=16)
+cpu_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Listings of the original images keyed by bucket name
+listing_cache = TTLCache(maxsize=4, ttl=LISTING_CACHE_TTL)
+listing_cache_lock = threading.Lock()
+
+# Stored annotations keyed by blob name, used when Redis isn't configured. It's unbounded since every page load
+# reads all annotations, which would evict each entry of a smaller LRU before it's read again. An original
+# re-uploaded under the same name is annotated again into the same blob, so upload_annotation replaces the
+# cached entry; annotations written by other processes are only picked up on refresh.
+annotation_cache = Cache(maxsize=math.inf)
+annotation_cache_lock = threading.Lock()
+
+# Signed URLs of the original images keyed by blob name
+signed_url_cache = TTLCache(maxsize=math.inf, ttl=SIGNED_URL_CACHE_TTL)
+signed_url_cache_lock = threading.Lock()
+
+# Clients shared by all requests, so gRPC channels and HTTP connections are reused.
+# The async Vision and Redis clients bind their connections to the running event loop, so they are created on first use.
+_vision_client = None
+_storage_client = storage.Client()
+_redis_client = None
+
+# Concurrency caps shared by all requests; like the async clients they are created on first use on the server loop
+_semaphore = None
+_vision_semaphore = None
+
+# Clean-up tasks of abandoned asynchronous batch requests, referenced until done so they aren't garbage collected
+_background_tasks = set()
+
+
+def create_vision_client():
+    """Create the async Vision API client on a gRPC channel configured with VISION_CHANNEL_OPTIONS."""
+    channel = ImageAnnotatorGrpcAsyncIOTransport.create_channel(
+        'vision.googleapis.com:443', options=VISION_CHANNEL_OPTIONS
+    )
+    return vision.ImageAnnotatorAsyncClient(transport=ImageAnnotatorGrpcAsyncIOTransport(channel=channel))
+
+
 def initialize_clients():
-    """Initialize Google Vision API and Cloud Storage clients."""
-    vision_client = vision.ImageAnnotatorClient()
-    storage_client = storage.Client()
-    return vision_client, storage_client
+    """Return the shared Google Vision API and Cloud Storage clients."""
+    global _vision_client
+    if _vision_client is None:
+        _vision_client = create_vision_client()
+    return _vision_client, _storage_client
+
+
+def get_semaphores():
+    """Return the shared GCS transfer and Vision request semaphores."""
+    global _semaphore, _vision_semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        _vision_semaphore = asyncio.Semaphore(MAX_CONCURRENT_VISION_REQUESTS)
+    return _semaphore, _vision_semaphore
+
+
+def get_redis_client():
+    """Return the shared Redis client, or None when no Redis instance is configured."""
+    global _redis_client
+    if _redis_client is None and REDIS_URL:
+        _redis_client = redis.from_url(
+            REDIS_URL, decode_responses=True, socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT
+        )
+    return _redis_client
 
 
-def get_image_blobs(storage_client):
-    """Get a list of image blobs that need to be processed from the bucket."""
+async def run_blocking(semaphore, func, *args):
+    """Run a blocking call on the I/O thread pool, holding the semaphore while it runs."""
+    async with semaphore:
+        return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+
+def image_stem(blob_name, prefix):
+    """Return the blob name without its prefix and extension; an original and its annotation share a stem."""
+    return os.path.splitext(blob_name[len(prefix):])[0]
+
+
+def annotation_blob_name(image_name):
+    """Return the name of the blob holding the annotation of an original image."""
+    return f'{BOXED_PREFIX}{image_stem(image_name, RAW_PREFIX)}.json'
+
+
+@cached(listing_cache, key=lambda storage_client: BUCKET_NAME, lock=listing_cache_lock)
+def list_raw_images(storage_client):
+    """List the original images of the bucket.
+
+    Maps each name to its annotation's blob name (None if unprocessed) and its generation, so an original
+    re-uploaded while being processed isn't flagged with the annotation of the previous upload.
+    """
     bucket = storage_client.bucket(BUCKET_NAME)
-    blobs = list(bucket.list_blobs())
 
-    # Identify blobs with "__boxed.png" in the name
-    boxed_blobs = {blob.name.split('__boxed.png')[0] for blob in blobs if "__boxed.png" in blob.name}
+    # Only request names, generations and metadata; nextPageToken is needed for paging
+    return {
+        blob.name: ((blob.metadata or {}).get(ANNOTATION_METADATA_KEY), blob.generation)
+        for blob in bucket.list_blobs(prefix=RAW_PREFIX, fields='items(name,generation,metadata),nextPageToken')
+        if blob.name[blob.name.rfind('.'):].lower() in IMAGE_EXTENSIONS
+    }
 
-    # Filter out blobs with "__boxed.png" in their names
-    image_blobs = [
-        blob for blob in blobs
-        if "__boxed.png" not in blob.name and
-           blob.name.split('.')[0] not in boxed_blobs and
-           blob.name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp'))
-    ]
 
-    return image_blobs, blobs
+def invalidate_raw_images():
+    """Drop the cached listing so images processed since are seen as such by the next request."""
+    with listing_cache_lock:
+        listing_cache.pop(BUCKET_NAME, None)
 
 
-def process_blob(blob, vision_client, bucket):
-    """Process a single blob, detect text, draw bounding boxes, and upload the modified image."""
-    logging.info(f'Processing file: {blob.name}')
+def download_annotation(storage_client, blob_name):
+    """Download and parse the stored annotation of an image, or return None if it's missing from the bucket."""
+    try:
+        return json.loads(storage_client.bucket(BUCKET_NAME).blob(blob_name).download_as_text())
+    except NotFound:
+        logging.warning('Annotation %s is missing from the bucket, annotating its image again', blob_name)
+        return None
+
+
+@cached(annotation_cache, key=lambda storage_client, blob_name: blob_name, lock=annotation_cache_lock)
+def read_annotation(storage_client, blob_name):
+    """Get the stored annotation of an image from the in-process cache, downloading it on a miss."""
+    return download_annotation(storage_client, blob_name)
+
+
+def invalidate_annotations():
+    """Drop the cached annotations so the next request downloads them again."""
+    with annotation_cache_lock:
+        annotation_cache.clear()
+
+
+async def read_annotations(storage_client, names, semaphore, use_cache=True):
+    """Read the stored annotations with the given blob names, from the bucket or the in-process cache.
+
+    Annotations missing from the bucket are left out.
+    """
+    read = read_annotation if use_cache else download_annotation
+    annotations = await asyncio.gather(*(run_blocking(semaphore, read, storage_client, name) for name in names))
+    return {name: annotation for name, annotation in zip(names, annotations) if annotation is not None}
+
+
+async def cache_annotations(redis_client, annotations, stale_names=(), replace=False):
+    """Write annotations to Redis and drop stale ones; with replace=True the whole hash is replaced."""
+    if redis_client is None or not (annotations or stale_names or replace):
+        return
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            if replace:
+                pipe.delete(ANNOTATIONS_KEY)
+            if stale_names:
+                pipe.hdel(ANNOTATIONS_KEY, *stale_names)
+            if annotations:
+                pipe.hset(ANNOTATIONS_KEY, mapping={name: json.dumps(data) for name, data in annotations.items()})
+            await pipe.execute()
+    except redis.RedisError:
+        # Redis is only a cache; the bucket stays the source of truth
+        logging.exception('Could not write annotations to Redis')
+
+
+async def get_annotations(storage_client, redis_client, raw_images, refresh, semaphore):
+    """Get the stored annotations keyed by blob name, from Redis when possible and from the bucket otherwise."""
+    # The listing of the originals already names their annotations, so boxed/ doesn't need listing
+    names = {
+        annotation_name for annotation_name, generation in raw_images.values()
+        if annotation_name and annotation_name != ANNOTATION_NO_TEXT
+    }
+
+    if redis_client is not None and not refresh:
+        try:
+            cached_annotations = await redis_client.hgetall(ANNOTATIONS_KEY)
+        except redis.RedisError:
+            # Redis is only a cache, fall back to the bucket
+            logging.exception('Could not read annotations from Redis, reading them from the bucket')
+            cached_annotations = None
+        if cached_annotations:
+            # Keep Redis in line with the listing: drop the annotations of originals that were deleted or
+            # re-uploaded, and read the ones that never made it to Redis from the bucket
+            stale_names = [name for name in cached_annotations if name not in names]
+            missing = await read_annotations(
+                storage_client, [name for name in names if name not in cached_annotations], semaphore,
+                use_cache=False,
+            )
+            await cache_annotations(redis_client, missing, stale_names)
+
+            annotations = {
+                name: json.loads(data) for name, data in cached_annotations.items() if name in names
+            }
+            annotations.update(missing)
+            return annotations
+
+    # With Redis configured it is the shared cache, so the bucket is read directly rather than through a
+    # per-process cache that other processes can't update
+    annotations = await read_annotations(storage_client, list(names), semaphore, use_cache=redis_client is None)
+
+    # Replace the cached annotations with the fresh ones
+    await cache_annotations(redis_client, annotations, replace=True)
+
+    return annotations
+
+
+def get_image_blobs(storage_client, raw_images, annotations):
+    """Get the image blobs that don't have an annotation yet, or whose annotation is missing from the bucket.
+
+    The blobs refer to the listed generation, which flag_processed requires to still be the live one.
+    """
+    bucket = storage_client.bucket(BUCKET_NAME)
+    return [
+        bucket.blob(name, generation=generation)
+        for name, (annotation_name, generation) in raw_images.items()
+        if annotation_name is None or (annotation_name != ANNOTATION_NO_TEXT and annotation_name not in annotations)
+    ]
 
-    # Read the image content from GCS
-    content = blob.download_as_bytes()
 
-    # Prepare the image for the Google Vision API
-    image = vision.Image(content=content)
+def gcs_uri(blob_name):
+    """Return the gs:// URI of a blob in the bucket."""
+    return f'gs://{BUCKET_NAME}/{blob_name}'
 
-    # First attempt to detect text
-    response = vision_client.document_text_detection(image=image)
 
-    # Check for any errors in the response
+def check_response_error(response):
+    """Raise if the Vision API reported an error for an image."""
     if response.error.message:
         logging.error('Vision API error: %s', response.error.message)
         raise Exception(
@@ -62,124 +317,360 @@ def process_blob(blob, vision_client, bucket):
             'https://cloud.google.com/apis/design/errors'.format(response.error.message)
         )
 
-    texts = response.text_annotations
-
-    if not texts:
-        logging.info('No text detected on first attempt, preprocessing image and trying again.')
-
-        # Preprocess the image and try text detection again
-        preprocessed_image = preprocess_image_for_ocr(content)
-
-        # Convert preprocessed image to bytes for Vision API
-        with io.BytesIO() as output:
-            preprocessed_image.save(output, format="PNG")
-            preprocessed_content = output.getvalue()
-
-        preprocessed_image_vision = vision.Image(content=preprocessed_content)
-        response = vision_client.document_text_detection(image=preprocessed_image_vision)
-        texts = response.text_annotations
 
+async def annotate_images(vision_client, contents, vision_semaphore):
+    """Detect text on several images with a single batched Vision API request."""
+    requests = [
+        {
+            'image': {'content': content},
+            'features': [{'type_': vision.Feature.Type.DOCUMENT_TEXT_DETECTION}],
+        }
+        for content in contents
+    ]
+    async with vision_semaphore:
+        batch_response = await vision_client.batch_annotate_images(requests=requests)
+
+    # Check for any errors in the responses
+    for response in batch_response.responses:
+        check_response_error(response)
+
+    return list(batch_response.responses)
+
+
+def ocr_output_order(output_blob):
+    """Sort key putting the JSON files of an asynchronous batch request ("output-21-to-40.json") in request order."""
+    return int(re.search(r'(\d+)-to-\d+', output_blob.name).group(1))
+
+
+def read_ocr_output(output_blob):
+    """Download and parse a JSON file written by an asynchronous batch request."""
+    batch_response = vision.BatchAnnotateImagesResponse.from_json(
+        output_blob.download_as_text(), ignore_unknown_fields=True
+    )
+    return batch_response.responses
+
+
+def delete_ocr_outputs(bucket, output_prefix):
+    """Delete the JSON files written by an asynchronous batch request."""
+    output_blobs = list(bucket.list_blobs(prefix=output_prefix, fields='items(name),nextPageToken'))
+    bucket.delete_blobs(output_blobs, on_error=lambda blob: None)
+
+
+async def finish_abandoned_operation(operation, bucket, output_prefix, semaphore):
+    """Cancel an asynchronous batch request nobody waits for anymore, then delete its results once it has ended."""
+    try:
+        await operation.cancel()
+    except Exception:
+        logging.warning('Could not cancel the text detection writing to %s', output_prefix)
+    try:
+        await operation.result(timeout=OCR_ABANDONED_OPERATION_TIMEOUT)
+    except Exception:
+        # A cancelled or failed operation raises here, but has stopped writing all the same
+        pass
+    try:
+        await run_blocking(semaphore, delete_ocr_outputs, bucket, output_prefix)
+    except Exception:
+        logging.exception('Could not delete the text detection results under %s', output_prefix)
+
+
+def abandon_operation(operation, bucket, output_prefix, semaphore):
+    """Leave the clean-up of an unfinished asynchronous batch request to a background task."""
+    task = asyncio.get_running_loop().create_task(
+        finish_abandoned_operation(operation, bucket, output_prefix, semaphore)
+    )
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def annotate_gcs_images(vision_client, blobs, bucket, semaphore, vision_semaphore):
+    """Detect text on images stored in the bucket with an asynchronous batch request.
+
+    Vision reads the images straight from GCS and writes its results back as JSON,
+    so the images don't pass through this process for text detection.
+    """
+    output_prefix = f'{OCR_OUTPUT_PREFIX}{uuid.uuid4().hex}/'
+    requests = [
+        {
+            'image': {'source': {'image_uri': gcs_uri(blob.name)}},
+            'features': [{'type_': vision.Feature.Type.DOCUMENT_TEXT_DETECTION}],
+        }
+        for blob in blobs
+    ]
+    output_config = {
+        'gcs_destination': {'uri': gcs_uri(output_prefix)},
+        'batch_size': OCR_OUTPUT_BATCH_SIZE,
+    }
+    async with vision_semaphore:
+        operation = await vision_client.async_batch_annotate_images(requests=requests, output_config=output_config)
+    abandoned = False
+    try:
+        try:
+            await operation.result(timeout=OCR_OPERATION_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Vision may still be writing results, so they can't be deleted yet
+            abandoned = True
+            abandon_operation(operation, bucket, output_prefix, semaphore)
+            raise
+
+        # Read the small JSON results back in request order
+        output_blobs = sorted(
+            await run_blocking(semaphore, lambda: list(bucket.list_blobs(prefix=output_prefix))),
+            key=ocr_output_order,
+        )
+        responses = [
+            response
+            for output_responses in await asyncio.gather(
+                *(run_blocking(semaphore, read_ocr_output, output_blob) for output_blob in output_blobs)
+            )
+            for response in output_responses
+        ]
+    finally:
+        # Remove the results from the bucket, also when the request failed part-way
+        if not abandoned:
+            try:
+                await run_blocking(semaphore, delete_ocr_outputs, bucket, output_prefix)
+            except Exception:
+                logging.exception('Could not delete the text detection results under %s', output_prefix)
+
+    # Check for any errors in the responses
+    for response in responses:
+        check_response_error(response)
+
+    return responses
+
+
+def build_annotation(blob, response):
+    """Build the annotation of an image: its name, its size and the corners of every detected word's bounding box."""
+    page = response.full_text_annotation.pages[0]
+    return {
+        'image': blob.name,
+        'width': page.width,
+        'height': page.height,
+        'boxes': [
+            [[vertex.x, vertex.y] for vertex in text.bounding_poly.vertices]
+            for text in response.text_annotations[1:]  # Skip the first element which is the entire text block
+        ],
+    }
+
+
+async def process_blob(blob, response, bucket, redis_client, semaphore):
+    """Store the bounding boxes of the text detected in a single blob."""
+    texts = response.text_annotations
     if texts:
         logging.info('Detected text: "%s"', texts[0].description)
 
-        # Draw bounding boxes around detected text
-        img_with_boxes = draw_bounding_boxes(content, texts)
+        # Upload the bounding boxes; the browser draws them over the original image
+        annotation = build_annotation(blob, response)
+        await run_blocking(semaphore, upload_annotation, annotation, blob, bucket)
 
-        # Upload the image with bounding boxes
-        output_blob = upload_processed_image(img_with_boxes, blob, bucket)
+        # Cache it right away, so it isn't lost if the rest of the request fails
+        await cache_annotations(redis_client, {annotation_blob_name(blob.name): annotation})
 
-        return output_blob.public_url
+        return annotation
     else:
         logging.warning('No text found in the image after preprocessing.')
+
+        # Flag it all the same, so it isn't sent to Vision again on every page load
+        await run_blocking(semaphore, flag_processed, blob, ANNOTATION_NO_TEXT)
         return None
 
 
-# image enhancer
-def preprocess_image_for_ocr(image_content):
-    # Open the original image
-    image_stream = io.BytesIO(image_content)
-    with Image.open(image_stream) as img:
-        # Convert to grayscale
-        gray_img = img.convert('L')
+def prepare_retry_content(image_content):
+    """Decode and preprocess an image, returning the PNG bytes to send to the Vision API."""
+    # Preprocessing works on grayscale, so let the decoder produce it directly
+    preprocessed_image = preprocess_image_for_ocr(load_image(image_content, mode='L'))
 
-        # Apply Gaussian blur to reduce noise
-        blurred_img = gray_img.filter(ImageFilter.GaussianBlur(radius=1))
+    # Convert preprocessed image to bytes for Vision API
+    with io.BytesIO() as output:
+        preprocessed_image.save(output, format="PNG")
+        return output.getvalue()
 
-        # Increase contrast
-        enhancer = ImageEnhance.Contrast(blurred_img)
-        contrasted_img = enhancer.enhance(2.0)
 
-        # Adaptive thresholding using numpy
-        img_array = np.array(contrasted_img)
-        mean = np.mean(img_array)
-        binary_img = np.where(img_array > mean, 255, 0).astype(np.uint8)
+async def download_for_retry(blob, semaphore):
+    """Download an image and preprocess it on the CPU pool, so other downloads continue meanwhile."""
+    content = await run_blocking(semaphore, blob.download_as_bytes)
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, prepare_retry_content, content)
 
-        # Convert back to PIL image
-        processed_img = Image.fromarray(binary_img)
 
-        # Optionally sharpen the image
-        sharpener = ImageEnhance.Sharpness(processed_img)
-        sharpened_img = sharpener.enhance(2.0)
+async def process_blobs(blobs, responses, vision_client, bucket, redis_client, semaphore, vision_semaphore):
+    """Process a batch of blobs given their Vision API responses, retrying the ones without text in one API call."""
+    for blob in blobs:
+        logging.info(f'Processing file: {blob.name}')
 
-        return sharpened_img
+    # Preprocess the images where no text was detected and try them again as one batch
+    retry_indices = [i for i, response in enumerate(responses) if not response.text_annotations]
+    if retry_indices:
+        logging.info('No text detected on first attempt for %d image(s), preprocessing and trying again.',
+                     len(retry_indices))
 
+        # Only these images are downloaded, since preprocessing needs their pixels
+        preprocessed_contents = await asyncio.gather(
+            *(download_for_retry(blobs[i], semaphore) for i in retry_indices)
+        )
 
-def draw_bounding_boxes(image_content, texts):
-    """Draw bounding boxes on the image for the detected text."""
-    image_stream = io.BytesIO(image_content)
-    with Image.open(image_stream) as img:
-        draw = ImageDraw.Draw(img)
+        retry_responses = await annotate_images(vision_client, preprocessed_contents, vision_semaphore)
+        for i, response in zip(retry_indices, retry_responses):
+            responses[i] = response
 
-        # Draw bounding boxes around detected text
-        for text in texts[1:]:  # Skip the first element which is the entire text block
-            vertices = text.bounding_poly.vertices
-            box = [(vertex.x, vertex.y) for vertex in vertices]
-            draw.line(box + [box[0]], width=2, fill="red")
+    # Store the bounding boxes of the processed images concurrently
+    return await asyncio.gather(*(
+        process_blob(blob, response, bucket, redis_client, semaphore)
+        for blob, response in zip(blobs, responses)
+    ))
 
-    # Return the modified image with bounding boxes
-    output_image_stream = io.BytesIO()
-    img.save(output_image_stream, format='PNG')
-    output_image_stream.seek(0)
 
-    return output_image_stream
+def load_image(image_content, mode=None):
+    """Decode image bytes into a PIL image held in memory.
 
+    With a mode, JPEG images are decoded straight into it rather than decoded and converted afterwards.
+    """
+    img = Image.open(io.BytesIO(image_content))
+    if mode is not None:
+        img.draft(mode, img.size)
+    img.load()
+    return img
 
-def upload_processed_image(image_stream, blob, bucket):
-    """Upload the modified image with bounding boxes to the bucket."""
-    output_blob_name = f'{os.path.splitext(blob.name)[0]}__boxed.png'
-    output_blob = bucket.blob(output_blob_name)
 
-    # Upload the modified image
-    output_blob.upload_from_file(image_stream, content_type='image/png')
-    logging.info("Saved image with bounding boxes to %s in bucket %s", output_blob_name, BUCKET_NAME)
+# image enhancer
+def preprocess_image_for_ocr(img):
+    # Convert to grayscale once (unless already decoded as such); the remaining steps all work on this array
+    gray = np.asarray(img if img.mode == 'L' else img.convert('L'))
 
-    # Make the blob publicly accessible
-    output_blob.make_public()
+    # Apply a 3x3 box blur to reduce noise, summing shifted views of an edge-padded copy
+    padded = np.pad(gray, 1, mode='edge').astype(np.uint16)
+    rows = padded[:-2] + padded[1:-1] + padded[2:]
+    blurred = (rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:]) / 9.0
 
-    return output_blob
+    # Increase contrast around the mean level, like ImageEnhance.Contrast(2.0)
+    mean = blurred.mean()
+    contrasted = np.clip((blurred - mean) * 2.0 + mean, 0, 255).astype(np.uint8)
 
+    # Binarise against the Gaussian-weighted mean of each pixel's neighbourhood, which copes with uneven lighting
+    binary_img = cv2.adaptiveThreshold(
+        contrasted, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, blockSize=31, C=10
+    )
 
-def get_image_uris():
-    """Main function to detect text and add bounding boxes to images."""
-    vision_client, storage_client = initialize_clients()
+    # Convert back to PIL image
+    return Image.fromarray(binary_img)
 
-    # Get the image blobs
-    image_blobs, blobs = get_image_blobs(storage_client)
 
-    image_uris = []
+def upload_annotation(annotation, blob, bucket):
+    """Upload the annotation of an image to the bucket and flag the original image as processed."""
+    output_blob_name = annotation_blob_name(blob.name)
+    output_blob = bucket.blob(output_blob_name)
 
-    # Add all blobs with "__boxed.png" to image_uris (skip processing)
-    for blob in blobs:
-        if "__boxed.png" in blob.name:
-            logging.info('Skipping already processed image: %s', blob.name)
-            image_uris.append(blob.public_url)
+    # Upload the bounding boxes
+    output_blob.upload_from_string(json.dumps(annotation), content_type='application/json')
+    logging.info("Saved bounding boxes to %s in bucket %s", output_blob_name, BUCKET_NAME)
+
+    with annotation_cache_lock:
+        annotation_cache[output_blob_name] = annotation
+
+    flag_processed(blob, output_blob_name)
+
+
+def flag_processed(blob, annotation_name):
+    """Flag an original image as processed, so the listing alone tells which images still need work."""
+    blob.metadata = {ANNOTATION_METADATA_KEY: annotation_name}
+    try:
+        blob.patch(if_generation_match=blob.generation)
+    except (NotFound, PreconditionFailed):
+        # Replaced or deleted since it was listed; a new upload is annotated on the next page load
+        logging.warning('%s changed while being processed, leaving it unflagged', blob.name)
+
+    invalidate_raw_images()
+
+
+async def annotate_and_process(image_blobs, vision_client, bucket, redis_client, semaphore, vision_semaphore):
+    """Detect text on a chunk of images read from GCS, then process them in batches of VISION_BATCH_SIZE."""
+    # First attempt to detect text, with Vision reading the images directly from the bucket
+    responses = await annotate_gcs_images(vision_client, image_blobs, bucket, semaphore, vision_semaphore)
+
+    # Process the batches concurrently; while one waits on Vision, others download or upload
+    batch_starts = range(0, len(image_blobs), VISION_BATCH_SIZE)
+    return [
+        annotation
+        for processed_annotations in await asyncio.gather(*(
+            process_blobs(
+                image_blobs[start:start + VISION_BATCH_SIZE], responses[start:start + VISION_BATCH_SIZE],
+                vision_client, bucket, redis_client, semaphore, vision_semaphore,
+            )
+            for start in batch_starts
+        ))
+        for annotation in processed_annotations if annotation
+    ]
 
-    # Process each image blob
-    for blob in image_blobs:
-        processed_blob_uri = process_blob(blob, vision_client, storage_client.bucket(BUCKET_NAME))
-        if processed_blob_uri:
-            image_uris.append(processed_blob_uri)
 
-    return image_uris
+def signing_arguments(credentials):
+    """Return the extra generate_signed_url arguments needed to sign with the given credentials.
 
+    Service account keys sign locally. Credentials without a private key, like the default App Engine
+    or Compute Engine service account, sign through the IAM signBlob API instead, which requires the
+    service account to hold the Service Account Token Creator role on itself.
+    """
+    if isinstance(credentials, google.auth.credentials.Signing):
+        return {}
+    if not credentials.valid:
+        credentials.refresh(google.auth.transport.requests.Request())
+    return {'service_account_email': credentials.service_account_email, 'access_token': credentials.token}
 
+
+@cached(signed_url_cache, key=lambda storage_client, blob_name: blob_name, lock=signed_url_cache_lock)
+def sign_url(storage_client, blob_name):
+    """Return a signed URL the browser can load an original image from, reused for SIGNED_URL_CACHE_TTL."""
+    return storage_client.bucket(BUCKET_NAME).blob(blob_name).generate_signed_url(
+        expiration=SIGNED_URL_EXPIRATION, version='v4', **signing_arguments(storage_client._credentials)
+    )
+
+
+async def get_images(refresh=False):
+    """Main function to detect text on images and collect their bounding boxes.
+
+    Returns one dict per image with a signed "uri" of the original, its "width" and "height" and the
+    corner points of every detected word in "boxes". With refresh=True the cached
+    listing and annotations are ignored and the bucket is read again.
+    """
+    vision_client, storage_client = initialize_clients()
+    redis_client = get_redis_client()
+    semaphore, vision_semaphore = get_semaphores()
+    bucket = storage_client.bucket(BUCKET_NAME)
+
+    if refresh:
+        invalidate_raw_images()
+        invalidate_annotations()
+
+    # Get the original images, their stored annotations and the image blobs that still need one
+    raw_images = await run_blocking(semaphore, list_raw_images, storage_client)
+    annotations = await get_annotations(storage_client, redis_client, raw_images, refresh, semaphore)
+    image_blobs = get_image_blobs(storage_client, raw_images, annotations)
+
+    # Add all stored annotations (skip processing)
+    images = []
+    for name in sorted(annotations):
+        logging.info('Skipping already processed image: %s', name)
+        images.append(annotations[name])
+
+    # Process the image blobs in chunks of at most VISION_ASYNC_BATCH_SIZE images; each chunk moves on
+    # to its retries and uploads as soon as its own text detection finishes
+    new_annotations = [
+        annotation
+        for chunk_annotations in await asyncio.gather(*(
+            annotate_and_process(
+                image_blobs[start:start + VISION_ASYNC_BATCH_SIZE], vision_client, bucket, redis_client,
+                semaphore, vision_semaphore,
+            )
+            for start in range(0, len(image_blobs), VISION_ASYNC_BATCH_SIZE)
+        ))
+        for annotation in chunk_annotations
+    ]
+    images.extend(new_annotations)
+
+    # Signed URLs let the originals stay private without a per-blob ACL request. Signing with the RSA key
+    # (or through IAM) blocks, so the URLs the cache doesn't hold yet are signed on the thread pool.
+    with signed_url_cache_lock:
+        uris = {annotation['image']: signed_url_cache.get(annotation['image']) for annotation in images}
+    unsigned = [name for name, uri in uris.items() if uri is None]
+    uris.update(zip(unsigned, await asyncio.gather(
+        *(run_blocking(semaphore, sign_url, storage_client, name) for name in unsigned)
+    )))
+    return [dict(annotation, uri=uris[annotation['image']]) for annotation in images]